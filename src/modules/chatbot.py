@@ -1,48 +1,148 @@
+import logging
 import streamlit as st
 from langchain.chat_models import ChatOpenAI
-from langchain.chains import ConversationalRetrievalChain
-from langchain.prompts.prompt import PromptTemplate
+from langchain.chains import ConversationalRetrievalChain, LLMChain
+from langchain.chains.conversational_retrieval.prompts import CONDENSE_QUESTION_PROMPT
+from langchain.chains.question_answering import load_qa_chain
+from langchain.prompts.chat import ChatPromptTemplate, SystemMessagePromptTemplate, HumanMessagePromptTemplate
+from langchain.callbacks.base import BaseCallbackHandler
 from langchain.callbacks import get_openai_callback
+from langchain.schema import get_buffer_string
+
+from modules.embedder import get_embeddings
+from modules.semantic_cache import get_semantic_cache
 
 #fix Error: module 'langchain' has no attribute 'verbose'
 import langchain
 langchain.verbose = False
 
+logger = logging.getLogger(__name__)
+
+@st.cache_resource(show_spinner=False)
+def get_llm(model_name, temperature, openai_api_key, streaming=False):
+    """
+    Returns a ChatOpenAI client shared across reruns for the given settings.
+    The key is sent with every request, ChatOpenAI itself only sets the process-wide openai.api_key
+    """
+    return ChatOpenAI(
+        model_name=model_name, temperature=temperature, openai_api_key=openai_api_key,
+        streaming=streaming, model_kwargs={"api_key": openai_api_key},
+    )
+
+class StreamHandler(BaseCallbackHandler):
+    """
+    Writes the answer into a Streamlit container token by token while it is generated
+    """
+
+    def __init__(self, container):
+        self.container = container
+        self.text = ""
+
+    def on_llm_new_token(self, token, **kwargs):
+        self.text += token
+        self.container.markdown(self.text)
+
+class PromptCacheHandler(BaseCallbackHandler):
+    """
+    Accumulates prompt tokens and prompt tokens served from the provider cache in the session.
+    Streamed completions report no usage, so their prompt is counted with tiktoken
+    and their cached tokens are unknown
+    """
+
+    def __init__(self, llm):
+        self.llm = llm
+        self.prompt_tokens = {}
+
+    def count_tokens(self, messages):
+        try:
+            return self.llm.get_num_tokens_from_messages(messages)
+        except NotImplementedError:
+            # Models without a known message format are counted on the plain transcript
+            return self.llm.get_num_tokens(get_buffer_string(messages))
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self.prompt_tokens[run_id] = sum(self.count_tokens(prompt) for prompt in messages)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        counted_tokens = self.prompt_tokens.pop(run_id, 0)
+        token_usage = (response.llm_output or {}).get("token_usage", {})
+        stats = st.session_state.setdefault("prompt_cache", {"prompt_tokens": 0, "cached_tokens": 0})
+        stats["prompt_tokens"] += token_usage.get("prompt_tokens", counted_tokens)
+        stats["cached_tokens"] += (token_usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+
 class Chatbot:
 
-    def __init__(self, model_name, temperature, vectors):
+    # Only the last turns are sent to the model, so the prompt size stays constant as the chat grows
+    HISTORY_WINDOW = 4
+
+    def __init__(self, model_name, temperature, vectors, file_hash, openai_api_key):
         self.model_name = model_name
         self.temperature = temperature
         self.vectors = vectors
+        self.file_hash = file_hash
+        # Kept per instance, the environment variable is shared by every session of the process
+        self.openai_api_key = openai_api_key
 
-    qa_template = """
-        You are a helpful AI assistant named Robby. The user gives you a file its content is represented by the following pieces of context, use them to answer the question at the end.
-        If you don't know the answer, just say you don't know. Do NOT try to make up an answer.
-        If the question is not related to the context, politely respond that you are tuned to only answer questions that are related to the context.
-        Use as much detail as possible when responding.
+    # Static instructions and retrieved context come first and the question last,
+    # so consecutive calls share the longest possible prompt prefix for provider-side caching
+    qa_system_template = """You are a helpful AI assistant named Robby. The user gives you a file its content is represented by the following pieces of context, use them to answer the question at the end.
+If you don't know the answer, just say you don't know. Do NOT try to make up an answer.
+If the question is not related to the context, politely respond that you are tuned to only answer questions that are related to the context.
+Use as much detail as possible when responding.
 
-        context: {context}
-        =========
-        question: {question}
-        ======
-        """
+context: {context}
+========="""
+
+    qa_human_template = """question: {question}
+======"""
 
-    QA_PROMPT = PromptTemplate(template=qa_template, input_variables=["context","question" ])
+    QA_PROMPT = ChatPromptTemplate.from_messages([
+        SystemMessagePromptTemplate.from_template(qa_system_template),
+        HumanMessagePromptTemplate.from_template(qa_human_template),
+    ])
 
-    def conversational_chat(self, query):
+    def conversational_chat(self, query, stream_container=None):
         """
-        Start a conversational chat with a model via Langchain
+        Start a conversational chat with a model via Langchain,
+        answering from the semantic cache when a similar query was already answered.
+        The answer is streamed into stream_container when one is given
         """
-        llm = ChatOpenAI(model_name=self.model_name, temperature=self.temperature)
+        chat_history = st.session_state["history"][-self.HISTORY_WINDOW:]
+
+        # Only opening questions are cached, a follow-up depends on its conversation and would
+        # never match, so it does not pay for embedding the query
+        cache = None
+        if not chat_history:
+            query_embedding = get_embeddings(self.openai_api_key).embed_query(query)
+            cache = get_semantic_cache((self.file_hash, self.model_name, self.temperature))
+
+            answer = cache.lookup(query_embedding)
+            if answer is not None:
+                st.session_state["history"].append((query, answer))
+                return answer
+
+        llm = get_llm(self.model_name, self.temperature, self.openai_api_key)
+        streaming_llm = get_llm(self.model_name, self.temperature, self.openai_api_key, streaming=True)
 
         retriever = self.vectors.as_retriever()
 
+        # Only the answer is streamed, the standalone question is generated without streaming
+        chain = ConversationalRetrievalChain(
+            retriever=retriever,
+            combine_docs_chain=load_qa_chain(streaming_llm, chain_type="stuff", verbose=True, prompt=self.QA_PROMPT),
+            question_generator=LLMChain(llm=llm, prompt=CONDENSE_QUESTION_PROMPT, verbose=True),
+            verbose=True, return_source_documents=True, max_tokens_limit=4097)
+
+        callbacks = [PromptCacheHandler(llm)]
+        if stream_container is not None:
+            callbacks.append(StreamHandler(stream_container))
 
-        chain = ConversationalRetrievalChain.from_llm(llm=llm,
-            retriever=retriever, verbose=True, return_source_documents=True, max_tokens_limit=4097, combine_docs_chain_kwargs={'prompt': self.QA_PROMPT})
+        logger.debug("history len=%d", len(st.session_state["history"]))
+        chain_input = {"question": query, "chat_history": chat_history}
+        result = chain(chain_input, callbacks=callbacks)
 
-        chain_input = {"question": query, "chat_history": st.session_state["history"]}
-        result = chain(chain_input)
+        if cache is not None:
+            cache.insert(query_embedding, result["answer"])
 
         st.session_state["history"].append((query, result["answer"]))
         #count_tokens_chain(chain, chain_input)
@@ -1,15 +1,83 @@
 import os
-import pickle
+import copy
+import csv
+import hashlib
+import io
+import json
+import multiprocessing
+import shutil
 import tempfile
-from langchain.document_loaders.csv_loader import CSVLoader
-from langchain.vectorstores import FAISS
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import faiss
+import numpy as np
+import openai
+import pypdf
+import streamlit as st
+from langchain.docstore.document import Document
+from langchain.docstore.in_memory import InMemoryDocstore
 from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.document_loaders import PyPDFLoader
-from langchain.document_loaders import TextLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
+from modules.infinity_embeddings import InfinityEmbeddings
+from modules.openai_session import API_WORKERS_PER_SESSION
+from modules.pdf_parser import extract_pdf_pages
+from modules.vectorstore import BinaryFAISS, LocalFAISS, has_gpu, load_vectorstore, move_to_gpu
+
+# Vectorstores already loaded by this process, keyed by embeddings model and file hash,
+# the least recently used first
+INDEX_CACHE = OrderedDict()
+INDEX_CACHE_LOCK = threading.Lock()
+MAX_CACHED_INDEXES = 8
+
+# Serializes updates of the manifest between concurrent sessions
+MANIFEST_LOCK = threading.Lock()
+
+# One lock per manifest key, so concurrent uploads of the same new file embed it only once
+STORE_LOCKS = {}
+
+class ApiKeyEmbeddingClient:
+    """
+    Embedding endpoint sending its own API key with every request, since OpenAIEmbeddings
+    only sets the process-wide openai.api_key when it is created
+    """
+
+    def __init__(self, api_key):
+        self.api_key = api_key
+
+    def create(self, **kwargs):
+        return openai.Embedding.create(api_key=self.api_key, **kwargs)
+
+@st.cache_resource(show_spinner=False)
+def get_embeddings(openai_api_key):
+    """
+    Returns the embeddings client shared across reruns: OpenAI by default,
+    or a self-hosted Infinity server when EMBEDDINGS_BACKEND=infinity
+    """
+    if os.getenv("EMBEDDINGS_BACKEND") == "infinity":
+        return InfinityEmbeddings(
+            model=os.getenv("INFINITY_MODEL", "BAAI/bge-small-en-v1.5"),
+            infinity_api_url=os.getenv("INFINITY_URL", "http://localhost:7997"),
+        )
+
+    # 512 chunks of ~2000 characters stay under the per-request token limit of the embeddings API
+    embeddings = OpenAIEmbeddings(openai_api_key=openai_api_key, chunk_size=512, max_retries=6, request_timeout=60)
+    embeddings.client = ApiKeyEmbeddingClient(openai_api_key)
+    return embeddings
+
 class Embedder:
 
+    EMBEDDING_WORKERS = API_WORKERS_PER_SESSION
+    HNSW_M = 32
+    HNSW_EF_SEARCH = 64
+    # Documents with at least this many chunks are stored as binary codes to save memory
+    BINARY_QUANTIZATION_MIN_CHUNKS = 1000
+    # PDFs get one parsing process per this many pages, up to PDF_MAX_WORKERS
+    PDF_PARALLEL_MIN_PAGES = 50
+    PDF_MAX_WORKERS = 4
+
     def __init__(self):
         self.PATH = "embeddings"
         self.createEmbeddingsDir()
@@ -21,14 +89,69 @@ class Embedder:
         if not os.path.exists(self.PATH):
             os.mkdir(self.PATH)
 
-    def storeDocEmbeds(self, file, original_filename):
+    def embedDocuments(self, data, embeddings):
         """
-        Stores document embeddings using Langchain and FAISS
+        Embeds the documents in concurrent batches and returns their vectors
+        """
+        texts = [doc.page_content for doc in data]
+
+        # Spread the texts over the workers, keeping each batch within the API batch limit
+        batch_size = max(1, min(embeddings.chunk_size, -(-len(texts) // self.EMBEDDING_WORKERS)))
+        batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+
+        with ThreadPoolExecutor(max_workers=self.EMBEDDING_WORKERS) as executor:
+            batch_vectors = list(executor.map(embeddings.embed_documents, batches))
+
+        return [vector for batch in batch_vectors for vector in batch]
+
+    def buildVectorstore(self, data, embeddings):
+        """
+        Builds a FAISS vectorstore backed by an HNSW index for sub-linear search,
+        binary-quantized for large documents
+        """
+        vectors = np.array(self.embedDocuments(data, embeddings), dtype=np.float32)
+
+        if len(data) >= self.BINARY_QUANTIZATION_MIN_CHUNKS:
+            return BinaryFAISS.from_vectors(vectors, data, embeddings.embed_query)
+
+        if has_gpu():
+            # HNSW does not run on GPU, where brute-force search is faster anyway
+            index = faiss.IndexFlatL2(vectors.shape[1])
+        else:
+            index = faiss.IndexHNSWFlat(vectors.shape[1], self.HNSW_M)
+            index.hnsw.efSearch = self.HNSW_EF_SEARCH
+        index.add(vectors)
+
+        ids = [str(uuid.uuid4()) for _ in data]
+        docstore = InMemoryDocstore(dict(zip(ids, data)))
+
+        return LocalFAISS(embeddings.embed_query, index, docstore, dict(enumerate(ids)))
+
+    def extractPdfText(self, file):
+        """
+        Returns the text of every PDF page, splitting large PDFs in page ranges parsed in parallel
+        """
+        reader = pypdf.PdfReader(io.BytesIO(file))
+        page_count = len(reader.pages)
+        workers = min(os.cpu_count() or 1, -(-page_count // self.PDF_PARALLEL_MIN_PAGES), self.PDF_MAX_WORKERS)
+        if workers < 2:
+            return [page.extract_text() for page in reader.pages]
+
+        # Text extraction holds the GIL, so pages are split across processes rather than threads.
+        # Workers start from a fresh interpreter instead of forking the multithreaded server
+        step = -(-page_count // workers)
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(start_method)) as executor:
+            futures = [
+                executor.submit(extract_pdf_pages, file, start, min(start + step, page_count))
+                for start in range(0, page_count, step)
+            ]
+            return [text for future in futures for text in future.result()]
+
+    def loadDocuments(self, file, original_filename):
+        """
+        Parses the file content in memory into Langchain documents
         """
-        with tempfile.NamedTemporaryFile(mode="wb", delete=False) as tmp_file:
-            tmp_file.write(file)
-            tmp_file_path = tmp_file.name
-            
         def get_file_extension(uploaded_file):
             file_extension =  os.path.splitext(uploaded_file)[1].lower()
             
@@ -43,36 +166,156 @@ class Embedder:
         file_extension = get_file_extension(original_filename)
 
         if file_extension == ".csv":
-            loader = CSVLoader(file_path=tmp_file_path, encoding="utf-8",csv_args={
-                'delimiter': ',',})
-            data = loader.load()
+            # Same content and metadata as CSVLoader, one document per row
+            reader = csv.DictReader(io.StringIO(file.decode("utf-8"), newline=""), delimiter=",")
+            data = [
+                Document(
+                    page_content="\n".join(f"{k.strip()}: {v.strip()}" for k, v in row.items()),
+                    metadata={"source": original_filename, "row": i},
+                )
+                for i, row in enumerate(reader)
+            ]
 
         elif file_extension == ".pdf":
-            loader = PyPDFLoader(file_path=tmp_file_path)  
-            data = loader.load_and_split(text_splitter)
+            # Same content and metadata as PyPDFLoader, one document per page
+            pages = [
+                Document(page_content=text, metadata={"source": original_filename, "page": i})
+                for i, text in enumerate(self.extractPdfText(file))
+            ]
+            data = text_splitter.split_documents(pages)
         
         elif file_extension == ".txt":
-            loader = TextLoader(file_path=tmp_file_path, encoding="utf-8")
-            data = loader.load_and_split(text_splitter)
-            
-        embeddings = OpenAIEmbeddings()
+            text = Document(page_content=file.decode("utf-8"), metadata={"source": original_filename})
+            data = text_splitter.split_documents([text])
+
+        return data
+
+    def storeDocEmbeds(self, file, original_filename, file_hash, openai_api_key):
+        """
+        Stores document embeddings using Langchain and FAISS
+        """
+        data = self.loadDocuments(file, original_filename)
+
+        embeddings = get_embeddings(openai_api_key)
 
-        vectors = FAISS.from_documents(data, embeddings)
-        os.remove(tmp_file_path)
+        vectors = self.buildVectorstore(data, embeddings)
 
-        # Save the vectors to a pickle file
-        with open(f"{self.PATH}/{original_filename}.pkl", "wb") as f:
-            pickle.dump(vectors, f)
+        # Save the FAISS index and its docstore to a temporary folder, then rename it into place,
+        # so a saved index is never rewritten while another session has it memory-mapped
+        index_path = self.getIndexPath(file_hash, embeddings)
+        parent_path = os.path.dirname(index_path)
+        os.makedirs(parent_path, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(prefix=".tmp-", dir=parent_path)
+        vectors.save_local(folder_path=tmp_path)
 
-    def getDocEmbeds(self, file, original_filename):
+        if os.path.isdir(index_path) and not self.isIndexComplete(index_path):
+            # Move aside the incomplete folder of an interrupted save
+            stale_path = f"{tmp_path}.stale"
+            try:
+                os.replace(index_path, stale_path)
+            except FileNotFoundError:
+                pass
+            shutil.rmtree(stale_path, ignore_errors=True)
+
+        try:
+            os.replace(tmp_path, index_path)
+        except OSError:
+            # Another process saved the same index first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+        return index_path
+
+    @staticmethod
+    def isIndexComplete(index_path):
         """
-        Retrieves document embeddings
+        Returns True when the folder holds a fully saved index, the ids or pickled docstore being written last
         """
-        if not os.path.isfile(f"{self.PATH}/{original_filename}.pkl"):
-            self.storeDocEmbeds(file, original_filename)
+        return any(
+            os.path.isfile(os.path.join(index_path, f"{index_name}.{extension}"))
+            for index_name in ("index", BinaryFAISS.INDEX_NAME)
+            for extension in ("ids.npy", "pkl")
+        )
 
-        # Load the vectors from the pickle file
-        with open(f"{self.PATH}/{original_filename}.pkl", "rb") as f:
-            vectors = pickle.load(f)
-        
+    def getIndexPath(self, file_hash, embeddings):
+        """
+        Returns the folder of the saved index, named after the file content so identical
+        uploads share it, and separated per embeddings model since their vectors differ
+        """
+        return os.path.join(self.PATH, embeddings.model.replace("/", "_"), file_hash)
+
+    def readManifest(self):
+        """
+        Returns the manifest mapping "<embeddings model>:<file hash>" to the folder of a fully saved index
+        """
+        manifest_path = os.path.join(self.PATH, "manifest.json")
+        if not os.path.isfile(manifest_path):
+            return {}
+
+        with open(manifest_path, "r") as f:
+            return json.load(f)
+
+    def updateManifest(self, key, index_path):
+        """
+        Records a saved index in the manifest, replacing the file atomically
+        """
+        manifest_path = os.path.join(self.PATH, "manifest.json")
+        with MANIFEST_LOCK:
+            manifest = self.readManifest()
+            manifest[key] = index_path
+
+            with open(f"{manifest_path}.tmp", "w") as f:
+                json.dump(manifest, f, indent=2)
+            os.replace(f"{manifest_path}.tmp", manifest_path)
+
+    @staticmethod
+    def getFileHash(uploaded_file):
+        """
+        Returns a short SHA256 of the uploaded file content, used to name and key caches by document
+        """
+        # getvalue() shares the upload's bytes, getbuffer() would copy them first
+        return hashlib.sha256(uploaded_file.getvalue()).hexdigest()[:16]
+
+    def getDocEmbeds(self, uploaded_file, file_hash, openai_api_key):
+        """
+        Retrieves document embeddings, from memory when this file was already loaded.
+        The uploaded file is only read when its embeddings were never stored
+        """
+        embeddings = get_embeddings(openai_api_key)
+        manifest_key = f"{embeddings.model}:{file_hash}"
+
+        with INDEX_CACHE_LOCK:
+            vectors = INDEX_CACHE.get(manifest_key)
+            if vectors is not None:
+                INDEX_CACHE.move_to_end(manifest_key)
+
+        if vectors is None:
+            vectors = self.loadDocEmbeds(uploaded_file, file_hash, openai_api_key, manifest_key)
+            with INDEX_CACHE_LOCK:
+                INDEX_CACHE[manifest_key] = vectors
+                if len(INDEX_CACHE) > MAX_CACHED_INDEXES:
+                    INDEX_CACHE.popitem(last=False)
+
+        # The index is shared, but queries are embedded with the client of the current session
+        vectors = copy.copy(vectors)
+        vectors.embedding_function = embeddings.embed_query
         return vectors
+
+    def loadDocEmbeds(self, uploaded_file, file_hash, openai_api_key, manifest_key):
+        """
+        Loads the saved vectorstore of the file, storing its embeddings first when they were never stored
+        """
+        embeddings = get_embeddings(openai_api_key)
+
+        # Only embed content that no session has fully stored yet for this embeddings model
+        with STORE_LOCKS.setdefault(manifest_key, threading.Lock()):
+            index_path = self.readManifest().get(manifest_key)
+            if index_path is None or not self.isIndexComplete(index_path):
+                index_path = self.getIndexPath(file_hash, embeddings)
+                # Folders saved before the manifest existed are reused when complete
+                if not self.isIndexComplete(index_path):
+                    self.storeDocEmbeds(uploaded_file.getvalue(), uploaded_file.name, file_hash, openai_api_key)
+                self.updateManifest(manifest_key, index_path)
+
+        # Load the vectors from the saved FAISS folder
+        vectors = load_vectorstore(index_path, embeddings)
+        return move_to_gpu(vectors)
@@ -3,7 +3,10 @@ import streamlit as st
 from streamlit_chat import message
 
 class ChatHistory:
-    
+
+    # Only the latest turns are rendered as chat components, each of which is a separate frontend iframe
+    MAX_RENDERED_TURNS = 10
+
     def __init__(self):
         self.history = st.session_state.get("history", [])
         st.session_state["history"] = self.history
@@ -39,7 +42,16 @@ class ChatHistory:
     def generate_messages(self, container):
         if st.session_state["assistant"]:
             with container:
-                for i in range(len(st.session_state["assistant"])):
+                first_rendered = max(0, len(st.session_state["assistant"]) - self.MAX_RENDERED_TURNS)
+
+                # Older turns are rendered as plain markdown, which is far cheaper to send and draw
+                if first_rendered:
+                    with st.expander(f"Earlier messages ({first_rendered})"):
+                        for i in range(first_rendered):
+                            st.markdown(f"**You:** {st.session_state['user'][i]}")
+                            st.markdown(f"**Robby:** {st.session_state['assistant'][i]}")
+
+                for i in range(first_rendered, len(st.session_state["assistant"])):
                     message(
                         st.session_state["user"][i],
                         is_user=True,
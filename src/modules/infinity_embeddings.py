@@ -0,0 +1,28 @@
+import requests
+from langchain.embeddings.base import Embeddings
+
+class InfinityEmbeddings(Embeddings):
+    """
+    Embeddings computed by a self-hosted Infinity server (https://github.com/michaelfeil/infinity)
+    through its OpenAI-compatible REST API
+    """
+
+    chunk_size = 256
+
+    def __init__(self, model, infinity_api_url, request_timeout=60):
+        self.model = model
+        self.infinity_api_url = infinity_api_url.rstrip("/")
+        self.request_timeout = request_timeout
+        self.session = requests.Session()
+
+    def embed_documents(self, texts):
+        response = self.session.post(
+            f"{self.infinity_api_url}/embeddings",
+            json={"model": self.model, "input": texts},
+            timeout=self.request_timeout,
+        )
+        response.raise_for_status()
+        return [item["embedding"] for item in sorted(response.json()["data"], key=lambda item: item["index"])]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
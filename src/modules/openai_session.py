@@ -0,0 +1,20 @@
+import os
+import openai
+import requests
+
+# openai keeps one HTTP session per thread and Streamlit runs every rerun in a new thread,
+# so this module installs one process-wide session keeping the connections to the API open
+# across reruns. It is imported by the modules creating OpenAI clients before any request
+
+# Threads of one session calling the API at the same time, the embedding workers of Embedder
+API_WORKERS_PER_SESSION = 4
+# Sessions expected to call the API concurrently, each one needs its own pooled connections
+# or urllib3 discards the extra ones once the pool is full
+CONCURRENT_SESSIONS = int(os.getenv("OPENAI_CONCURRENT_SESSIONS", "8"))
+
+openai.requestssession = requests.Session()
+# Same connection retries as the sessions openai creates itself
+openai.requestssession.mount(
+    "https://",
+    requests.adapters.HTTPAdapter(max_retries=2, pool_maxsize=API_WORKERS_PER_SESSION * CONCURRENT_SESSIONS),
+)
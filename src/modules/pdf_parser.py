@@ -0,0 +1,11 @@
+import io
+import pypdf
+
+# Imported by the PDF worker processes, so it only depends on pypdf
+
+def extract_pdf_pages(file, start, stop):
+    """
+    Extracts the text of the PDF pages in [start, stop), run in a worker process
+    """
+    reader = pypdf.PdfReader(io.BytesIO(file))
+    return [reader.pages[i].extract_text() for i in range(start, stop)]
@@ -0,0 +1,78 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+import faiss
+
+# Semantic caches of opening questions shared by all sessions of this process, keyed by document
+# and conversation settings, the least recently used first
+SEMANTIC_CACHES = OrderedDict()
+SEMANTIC_CACHES_LOCK = threading.Lock()
+MAX_SEMANTIC_CACHES = 256
+
+class SemanticCache:
+
+    SIMILARITY_THRESHOLD = 0.95
+    MAX_ENTRIES = 100
+
+    def __init__(self):
+        self.index = None
+        self.answers = []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def normalize(embedding):
+        """
+        Returns the embedding as a unit-length float32 row, so inner product is cosine similarity
+        """
+        vector = np.array([embedding], dtype=np.float32)
+        faiss.normalize_L2(vector)
+        return vector
+
+    def lookup(self, embedding):
+        """
+        Returns the cached answer of the most similar previous query, or None below the threshold
+        """
+        with self.lock:
+            if self.index is None:
+                return None
+            scores, ids = self.index.search(self.normalize(embedding), 1)
+
+            if ids[0][0] != -1 and scores[0][0] >= self.SIMILARITY_THRESHOLD:
+                # Move the entry to the end so the least recently used one is evicted first.
+                # Flat index ids shift down on removal, like the positions in the answers list
+                i = int(ids[0][0])
+                vector = self.index.reconstruct(i).reshape(1, -1)
+                self.index.remove_ids(np.array([i], dtype=np.int64))
+                self.index.add(vector)
+                self.answers.append(self.answers.pop(i))
+                return self.answers[-1]
+        return None
+
+    def insert(self, embedding, answer):
+        """
+        Stores the answer of a query under its embedding, evicting the least recently used entry when full
+        """
+        vector = self.normalize(embedding)
+        with self.lock:
+            if self.index is None:
+                self.index = faiss.IndexFlatIP(vector.shape[1])
+            if self.index.ntotal >= self.MAX_ENTRIES:
+                self.index.remove_ids(np.array([0], dtype=np.int64))
+                self.answers.pop(0)
+            self.index.add(vector)
+            self.answers.append(answer)
+
+
+def get_semantic_cache(key):
+    """
+    Returns the semantic cache for the given key, creating it on first use
+    and dropping the least recently used cache beyond MAX_SEMANTIC_CACHES
+    """
+    with SEMANTIC_CACHES_LOCK:
+        if key in SEMANTIC_CACHES:
+            SEMANTIC_CACHES.move_to_end(key)
+        else:
+            SEMANTIC_CACHES[key] = SemanticCache()
+            if len(SEMANTIC_CACHES) > MAX_SEMANTIC_CACHES:
+                SEMANTIC_CACHES.popitem(last=False)
+        return SEMANTIC_CACHES[key]
@@ -6,6 +6,17 @@ import pdfplumber
 from modules.chatbot import Chatbot
 from modules.embedder import Embedder
 
+@st.cache_data(show_spinner=False, max_entries=16)
+def extract_pdf_preview(file_hash, _uploaded_file):
+    """
+    Returns the text of the PDF pages for the preview, extracted once per file content
+    """
+    with pdfplumber.open(_uploaded_file) as pdf:
+        pdf_text = ""
+        for page in pdf.pages:
+            pdf_text += page.extract_text() + "\n\n"
+    return pdf_text
+
 class Utilities:
 
     @staticmethod
@@ -51,10 +62,7 @@ class Utilities:
 
             def show_pdf_file(uploaded_file):
                 file_container = st.expander("Your PDF file :")
-                with pdfplumber.open(uploaded_file) as pdf:
-                    pdf_text = ""
-                    for page in pdf.pages:
-                        pdf_text += page.extract_text() + "\n\n"
+                pdf_text = extract_pdf_preview(Utilities.get_file_hash(uploaded_file), uploaded_file)
                 file_container.write(pdf_text)
             
             def show_txt_file(uploaded_file):
@@ -79,24 +87,33 @@ class Utilities:
         else:
             st.session_state["reset_chat"] = True
 
-        #print(uploaded_file)
         return uploaded_file
 
     @staticmethod
-    def setup_chatbot(uploaded_file, model, temperature):
+    def get_file_hash(uploaded_file):
+        """
+        Returns the hash of the uploaded file content, computed once per upload and session
+        """
+        file_hashes = st.session_state.setdefault("file_hashes", {})
+        if uploaded_file.id not in file_hashes:
+            file_hashes[uploaded_file.id] = Embedder.getFileHash(uploaded_file)
+        return file_hashes[uploaded_file.id]
+
+    @staticmethod
+    def setup_chatbot(uploaded_file, model, temperature, openai_api_key):
         """
-        Sets up the chatbot with the uploaded file, model, and temperature
+        Sets up the chatbot with the uploaded file, model, temperature and the session's API key
         """
         embeds = Embedder()
 
         with st.spinner("Processing..."):
-            uploaded_file.seek(0)
-            file = uploaded_file.read()
+            # The display keeps using the file name
+            file_hash = Utilities.get_file_hash(uploaded_file)
             # Get the document embeddings for the uploaded file
-            vectors = embeds.getDocEmbeds(file, uploaded_file.name)
+            vectors = embeds.getDocEmbeds(uploaded_file, file_hash, openai_api_key)
 
             # Create a Chatbot instance with the specified model and temperature
-            chatbot = Chatbot(model, temperature,vectors)
+            chatbot = Chatbot(model, temperature, vectors, file_hash, openai_api_key)
         st.session_state["ready"] = True
 
         return chatbot
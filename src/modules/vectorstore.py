@@ -0,0 +1,237 @@
+import os
+import contextlib
+import pickle
+import threading
+import uuid
+from pathlib import Path
+import faiss
+import numpy as np
+import orjson
+import streamlit as st
+from langchain.docstore.document import Document
+from langchain.docstore.in_memory import InMemoryDocstore
+from langchain.vectorstores import FAISS
+from langchain.vectorstores.utils import maximal_marginal_relevance
+
+# Saved indexes are memory-mapped instead of copied to the heap, so pages load on demand
+# and are shared between processes. IO_FLAG_MMAP_IFC also maps flat codes on recent FAISS
+MMAP_FLAGS = faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_MMAP_IFC", 0) | faiss.IO_FLAG_READ_ONLY
+
+def has_gpu():
+    """
+    Returns True when FAISS was built with GPU support and a GPU is visible
+    """
+    return faiss.get_num_gpus() > 0
+
+
+# FAISS GPU resources and GPU indexes are not thread-safe, while Streamlit sessions search
+# the shared GPU indexes from their own threads, so GPU searches run one at a time
+GPU_LOCK = threading.Lock()
+
+@st.cache_resource(show_spinner=False)
+def get_gpu_resources():
+    """
+    Returns the FAISS GPU resources shared by every index of this process
+    """
+    return faiss.StandardGpuResources()
+
+
+def move_to_gpu(vectors):
+    """
+    Moves a flat FAISS index to the first GPU when one is available, other indexes stay on CPU
+    """
+    if has_gpu() and isinstance(vectors.index, faiss.IndexFlat):
+        vectors.index = faiss.index_cpu_to_gpu(get_gpu_resources(), 0, vectors.index)
+        vectors.search_lock = GPU_LOCK
+    return vectors
+
+
+class LocalFAISS(FAISS):
+    """
+    FAISS vectorstore saving its docstore as JSON and loading its saved index memory-mapped
+    """
+
+    # Set by move_to_gpu, searches of CPU indexes run concurrently
+    search_lock = None
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4):
+        with self.search_lock or contextlib.nullcontext():
+            return super().similarity_search_with_score_by_vector(embedding, k)
+
+    def max_marginal_relevance_search_by_vector(self, embedding, k=4, fetch_k=20, lambda_mult=0.5, **kwargs):
+        with self.search_lock or contextlib.nullcontext():
+            return super().max_marginal_relevance_search_by_vector(
+                embedding, k=k, fetch_k=fetch_k, lambda_mult=lambda_mult, **kwargs
+            )
+
+    def save_docstore(self, path, index_name):
+        """
+        Writes the documents with orjson and the index to id mapping as a numpy array
+        """
+        documents = {
+            _id: {"page_content": doc.page_content, "metadata": doc.metadata}
+            for _id, doc in self.docstore._dict.items()
+        }
+        with open(path / f"{index_name}.json", "wb") as f:
+            f.write(orjson.dumps(documents, option=orjson.OPT_SERIALIZE_NUMPY))
+
+        ids = [self.index_to_docstore_id[i] for i in range(len(self.index_to_docstore_id))]
+        np.save(path / f"{index_name}.ids.npy", np.array(ids))
+
+    @staticmethod
+    def load_docstore(path, index_name):
+        """
+        Reads the documents and the index to id mapping, from the pickle of older saves if needed
+        """
+        if not (path / f"{index_name}.json").is_file():
+            with open(path / f"{index_name}.pkl", "rb") as f:
+                return pickle.load(f)
+
+        with open(path / f"{index_name}.json", "rb") as f:
+            documents = orjson.loads(f.read())
+        docstore = InMemoryDocstore({_id: Document(**doc) for _id, doc in documents.items()})
+
+        ids = np.load(path / f"{index_name}.ids.npy")
+        return docstore, dict(enumerate(ids.tolist()))
+
+    def save_local(self, folder_path, index_name="index"):
+        path = Path(folder_path)
+        path.mkdir(exist_ok=True, parents=True)
+
+        faiss.write_index(self.index, str(path / f"{index_name}.faiss"))
+        self.save_docstore(path, index_name)
+
+    @classmethod
+    def load_local(cls, folder_path, embeddings, index_name="index"):
+        path = Path(folder_path)
+
+        index = faiss.read_index(str(path / f"{index_name}.faiss"), MMAP_FLAGS)
+        docstore, index_to_docstore_id = cls.load_docstore(path, index_name)
+
+        return cls(embeddings.embed_query, index, docstore, index_to_docstore_id)
+
+    # Loaded indexes are read-only memory-mapped views, which FAISS aborts the whole process on
+    # when they are extended, so these are refused with an exception instead
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        raise NotImplementedError("Saved indexes are memory-mapped read-only and cannot be extended")
+
+    def add_embeddings(self, text_embeddings, metadatas=None, **kwargs):
+        raise NotImplementedError("Saved indexes are memory-mapped read-only and cannot be extended")
+
+    def merge_from(self, target):
+        raise NotImplementedError("Saved indexes are memory-mapped read-only and cannot be merged")
+
+
+class BinaryFAISS(LocalFAISS):
+    """
+    FAISS vectorstore searching sign-binarized embeddings by Hamming distance,
+    then reranking the candidates with int8-quantized embeddings
+    """
+
+    INDEX_NAME = "binary"
+    RERANK_CANDIDATES = 100
+
+    def __init__(self, embedding_function, index, docstore, index_to_docstore_id, codes, scales, **kwargs):
+        super().__init__(embedding_function, index, docstore, index_to_docstore_id, **kwargs)
+        self.codes = codes
+        self.scales = scales
+
+    @staticmethod
+    def binarize(vectors):
+        """
+        Packs the sign bit of every dimension, 1 bit per dimension instead of 32
+        """
+        return np.packbits(vectors > 0, axis=1)
+
+    @staticmethod
+    def quantize(vectors):
+        """
+        Quantizes each vector to int8 with its own scale, used to rerank the binary candidates
+        """
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1
+        codes = np.round(vectors / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+
+    @classmethod
+    def from_vectors(cls, vectors, documents, embedding_function):
+        """
+        Builds the binary index and the int8 rerank codes from float embeddings
+        """
+        # Brute-force popcount search is exact and takes microseconds at document sizes,
+        # an approximate graph would lose candidates before the rerank
+        index = faiss.IndexBinaryFlat(vectors.shape[1])
+        index.add(cls.binarize(vectors))
+        codes, scales = cls.quantize(vectors)
+
+        ids = [str(uuid.uuid4()) for _ in documents]
+        docstore = InMemoryDocstore(dict(zip(ids, documents)))
+
+        return cls(embedding_function, index, docstore, dict(enumerate(ids)), codes, scales)
+
+    def rerank_candidates(self, embedding, k):
+        """
+        Returns the ids of the k nearest Hamming candidates reranked by L2 distance to their
+        dequantized embeddings, with those distances and embeddings
+        """
+        query = np.array([embedding], dtype=np.float32)
+        _, indices = self.index.search(self.binarize(query), max(k, self.RERANK_CANDIDATES))
+        candidates = indices[0][indices[0] != -1]
+
+        approximations = self.codes[candidates].astype(np.float32) * self.scales[candidates, None]
+        distances = ((approximations - query) ** 2).sum(axis=1)
+
+        order = np.argsort(distances)[:k]
+        return candidates[order], distances[order], approximations[order]
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4):
+        ids, distances, _ = self.rerank_candidates(embedding, k)
+        return [
+            (self.docstore.search(self.index_to_docstore_id[int(i)]), float(distance))
+            for i, distance in zip(ids, distances)
+        ]
+
+    def max_marginal_relevance_search_by_vector(self, embedding, k=4, fetch_k=20, lambda_mult=0.5, **kwargs):
+        ids, _, approximations = self.rerank_candidates(embedding, fetch_k)
+        selected = maximal_marginal_relevance(
+            np.array(embedding, dtype=np.float32), approximations, lambda_mult=lambda_mult, k=k
+        )
+        return [self.docstore.search(self.index_to_docstore_id[int(ids[j])]) for j in selected]
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        raise NotImplementedError("Binary indexes are built once by from_vectors and cannot be extended")
+
+    def add_embeddings(self, text_embeddings, metadatas=None, **kwargs):
+        raise NotImplementedError("Binary indexes are built once by from_vectors and cannot be extended")
+
+    def merge_from(self, target):
+        raise NotImplementedError("Binary indexes are built once by from_vectors and cannot be merged")
+
+    def save_local(self, folder_path, index_name=INDEX_NAME):
+        path = Path(folder_path)
+        path.mkdir(exist_ok=True, parents=True)
+
+        faiss.write_index_binary(self.index, str(path / f"{index_name}.faiss"))
+        np.save(path / f"{index_name}.codes.npy", self.codes)
+        np.save(path / f"{index_name}.scales.npy", self.scales)
+        self.save_docstore(path, index_name)
+
+    @classmethod
+    def load_local(cls, folder_path, embeddings, index_name=INDEX_NAME):
+        path = Path(folder_path)
+
+        index = faiss.read_index_binary(str(path / f"{index_name}.faiss"), MMAP_FLAGS)
+        codes = np.load(path / f"{index_name}.codes.npy", mmap_mode="r")
+        scales = np.load(path / f"{index_name}.scales.npy", mmap_mode="r")
+        docstore, index_to_docstore_id = cls.load_docstore(path, index_name)
+
+        return cls(embeddings.embed_query, index, docstore, index_to_docstore_id, codes, scales)
+
+
+def load_vectorstore(folder_path, embeddings):
+    """
+    Loads a saved vectorstore with the class that wrote it
+    """
+    if os.path.isfile(os.path.join(folder_path, f"{BinaryFAISS.INDEX_NAME}.faiss")):
+        return BinaryFAISS.load_local(folder_path, embeddings)
+    return LocalFAISS.load_local(folder_path, embeddings)
@@ -38,8 +38,7 @@ user_api_key = utils.load_api_key()
 if not user_api_key:
     layout.show_api_key_missing()
 else:
-    os.environ["OPENAI_API_KEY"] = user_api_key
-
+    # The key is passed down explicitly, os.environ is shared by the concurrent sessions of the server
     uploaded_file = utils.handle_upload(["pdf", "txt", "csv"])
 
     if uploaded_file:
@@ -52,7 +51,7 @@ else:
         history = ChatHistory()
         try:
             chatbot = utils.setup_chatbot(
-                uploaded_file, st.session_state["model"], st.session_state["temperature"]
+                uploaded_file, st.session_state["model"], st.session_state["temperature"], user_api_key
             )
             st.session_state["chatbot"] = chatbot
 
@@ -78,7 +77,10 @@ else:
                         old_stdout = sys.stdout
                         sys.stdout = captured_output = StringIO()
 
-                        output = st.session_state["chatbot"].conversational_chat(user_input)
+                        # Show the answer as it streams, the full history is rendered afterwards
+                        stream_placeholder = st.empty()
+                        output = st.session_state["chatbot"].conversational_chat(user_input, stream_placeholder)
+                        stream_placeholder.empty()
 
                         sys.stdout = old_stdout
 
@@ -94,6 +96,11 @@ else:
                             st.write(cleaned_thoughts)
 
                 history.generate_messages(response_container)
+
+                # Prompt tokens sent this session and how many the provider served from its prompt cache
+                if "prompt_cache" in st.session_state:
+                    stats = st.session_state["prompt_cache"]
+                    st.caption(f"Prompt tokens: {stats['prompt_tokens']} · cached by the provider: {stats['cached_tokens']}")
         except Exception as e:
             st.error(f"Error: {str(e)}")
 